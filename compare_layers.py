@@ -0,0 +1,161 @@
+#!/Users/guorui/anaconda3/envs/psd/bin/python
+# -*- coding: utf-8 -*-
+"""
+比较两次导出的图层感知哈希，找出视觉上发生变化的图层（不解码原始切图）
+"""
+
+import io
+import os
+import sys
+import json
+import base64
+import argparse
+from PIL import Image, ImageChops, ImageStat
+
+
+def load_fingerprints(path):
+    """
+    读取图层索引中的视觉指纹
+
+    Args:
+        path: 输出目录（读取其中的 layers/index.json）或 index.json 文件路径
+
+    Returns:
+        {图层路径: 指纹}，索引不存在或没有指纹时返回 None
+    """
+    index_file = path
+    if os.path.isdir(path):
+        index_file = os.path.join(path, 'layers', 'index.json')
+    if not os.path.exists(index_file):
+        print(f"❌ 错误: 找不到索引文件 '{index_file}'")
+        return None
+
+    with open(index_file, 'r', encoding='utf-8') as f:
+        index_data = json.load(f)
+
+    fingerprints = index_data.get('fingerprints')
+    if fingerprints is None:
+        print(f"❌ 错误: '{index_file}' 中没有视觉指纹，请使用新版本重新导出")
+        return None
+    return {fp['path']: fp for fp in fingerprints}
+
+
+def hamming_distance(hash_a, hash_b):
+    """两个十六进制感知哈希之间的汉明距离"""
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count('1')
+
+
+def thumbnail_difference(uri_a, uri_b):
+    """
+    两张缩略图的平均像素差（0-255）
+
+    感知哈希只反映亮度结构，颜色变化（如纯色按钮换色）由缩略图比较补充。
+    缩略图缺失或尺寸不同时返回 None。
+    """
+    if not uri_a or not uri_b:
+        return None
+    images = []
+    for uri in (uri_a, uri_b):
+        raw = base64.b64decode(uri.split(',', 1)[1])
+        with Image.open(io.BytesIO(raw)) as img:
+            images.append(img.convert('RGBA'))
+    if images[0].size != images[1].size:
+        return None
+    diff = ImageChops.difference(images[0], images[1])
+    return sum(ImageStat.Stat(diff).mean) / 4
+
+
+def compare_fingerprints(old, new, threshold=6, color_threshold=8.0):
+    """
+    比较两组视觉指纹
+
+    Args:
+        old: 旧版本指纹 {路径: 指纹}
+        new: 新版本指纹 {路径: 指纹}
+        threshold: 汉明距离大于该值视为视觉变化
+        color_threshold: 哈希相近时，缩略图平均像素差大于该值也视为视觉变化
+
+    Returns:
+        包含 changed、added、removed、unchanged 的比较结果
+    """
+    changed = []
+    unchanged = 0
+    for path, fp in new.items():
+        if path not in old:
+            continue
+        distance = hamming_distance(old[path]['phash'], fp['phash'])
+        color_diff = None
+        if distance <= threshold:
+            color_diff = thumbnail_difference(old[path].get('thumbnail'), fp.get('thumbnail'))
+        if distance > threshold or (color_diff is not None and color_diff > color_threshold):
+            changed.append({
+                'path': path,
+                'distance': distance,
+                'color_difference': None if color_diff is None else round(color_diff, 2),
+                'old_src': old[path].get('src'),
+                'new_src': fp.get('src')
+            })
+        else:
+            unchanged += 1
+
+    return {
+        'threshold': threshold,
+        'color_threshold': color_threshold,
+        'changed': sorted(changed, key=lambda c: c['distance'], reverse=True),
+        'added': sorted(path for path in new if path not in old),
+        'removed': sorted(path for path in old if path not in new),
+        'unchanged': unchanged
+    }
+
+
+def compare_outputs(old_path, new_path, threshold=6, color_threshold=8.0, report_file=None):
+    """
+    比较两个输出目录，打印视觉变化的图层
+
+    Returns:
+        是否存在变化（变化、新增或删除的图层）；读取失败时返回 None
+    """
+    old = load_fingerprints(old_path)
+    new = load_fingerprints(new_path)
+    if old is None or new is None:
+        return None
+
+    result = compare_fingerprints(old, new, threshold, color_threshold)
+
+    print(f"🔍 比较 {old_path} → {new_path}（阈值 {threshold}）")
+    for item in result['changed']:
+        detail = f"距离 {item['distance']}"
+        if item['color_difference'] is not None:
+            detail += f", 颜色差 {item['color_difference']}"
+        print(f"  ⚠️  变化: {item['path']} ({detail})")
+    for path in result['added']:
+        print(f"  ➕ 新增: {path}")
+    for path in result['removed']:
+        print(f"  ➖ 删除: {path}")
+
+    if report_file:
+        with open(report_file, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+        print(f"  ✅ 报告: {report_file}")
+
+    has_changes = bool(result['changed'] or result['added'] or result['removed'])
+    print(f"\n{'⚠️  发现差异' if has_changes else '✅ 没有视觉变化'}："
+          f"变化 {len(result['changed'])} 个, 新增 {len(result['added'])} 个, "
+          f"删除 {len(result['removed'])} 个, 未变化 {result['unchanged']} 个")
+    return has_changes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='比较两次导出的图层视觉指纹')
+    parser.add_argument('old', help='旧版本输出目录或 layers/index.json')
+    parser.add_argument('new', help='新版本输出目录或 layers/index.json')
+    parser.add_argument('--threshold', type=int, default=6,
+                        help='汉明距离大于该值视为视觉变化（0-64）')
+    parser.add_argument('--color-threshold', type=float, default=8.0,
+                        help='缩略图平均像素差大于该值视为视觉变化（0-255）')
+    parser.add_argument('--report', help='将比较结果写入 JSON 文件')
+    args = parser.parse_args()
+
+    has_changes = compare_outputs(args.old, args.new, args.threshold,
+                                  args.color_threshold, args.report)
+    sys.exit(2 if has_changes is None else int(has_changes))
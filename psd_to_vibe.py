@@ -1,10 +1,32 @@
 import os
+import sys
 import json
+import base64
 import re
+import time
+import hashlib
+import tempfile
+import multiprocessing
+import importlib
+import argparse
+from fnmatch import fnmatchcase
+from functools import singledispatch
+from collections import Counter
 from datetime import datetime
 from psd_tools import PSDImage
+from psd_tools.api import effects as psd_effects
+from psd_tools.api.layers import PixelLayer, SmartObjectLayer, TypeLayer, ShapeLayer
+from psd_tools.constants import Tag
+from psd_tools.psd.layer_and_mask import LayerBlendingRanges
 from PIL import Image
+import numpy as np
 import logging
+from split_layers import sibling_paths
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
 # 配置日志
 logging.basicConfig(
@@ -18,12 +40,22 @@ PSD_FILE = '1920_new.psd'
 OUTPUT_DIR = 'vibe_context'
 ASSETS_DIR = os.path.join(OUTPUT_DIR, 'assets')
 
-# 设计令牌收集器
+# 设计令牌配置
+MAX_TOKENS = 20                   # 每类令牌最多输出的数量
+COLOR_CLUSTER_DISTANCE = 5.0      # Lab 空间中的聚类半径（ΔE76），小于该距离的颜色视为同一颜色
+SPACING_GRIDS = (8, 6, 5, 4)      # 候选间距网格，按优先级排列
+SPACING_MAX = 100                 # 只保留不超过该值的间距（吸附到网格后同样不超过）
+SPACING_GRID_MIN_SHARE = 0.5      # 间距落在网格上的占比（按出现次数加权）达到该值才采用该网格
+SAMPLE_PIXEL_COLORS = False       # 是否从像素图层的合成图中采样主色
+PIXEL_SAMPLE_SIZE = 64            # 采样前将合成图缩小到的最大边长
+
+# 设计令牌收集器（记录每个值的出现次数）
 design_tokens = {
-    "colors": set(),
-    "fonts": set(),
-    "font_sizes": set(),
-    "spacings": set()
+    "colors": Counter(),
+    "fonts": Counter(),
+    "font_sizes": Counter(),
+    "spacings": Counter(),
+    "pixel_colors": Counter()
 }
 
 # 组件识别规则
@@ -37,98 +69,148 @@ COMPONENT_PATTERNS = {
     "icon": ["图标", "icon", "ico"]
 }
 
+# 智能对象渲染缓存：按 unique_id + 数据哈希缓存合成结果，保存在输出目录中跨运行复用
+SMARTOBJECT_CACHE = True
+SMARTOBJECT_CACHE_DIRNAME = '.smartobject_cache'
+smartobject_cache = {
+    "index": None,          # 缓存键 -> {"unique_id", "data_hash", "renders": {"WxH": 文件名}}
+    "data_hashes": {},      # 本次运行中 unique_id -> 数据哈希，避免重复哈希同一份数据
+    "stats": Counter()      # hits / misses
+}
+
+# 图层合成限制：设置任一限制后，每个图层在独立的子进程中合成
+RENDER_TIMEOUT = None             # 单个图层的合成时间上限（秒），None 表示不限制
+RENDER_MEMORY_MB = None           # 合成子进程的额外内存上限（MB），None 表示不限制
+RENDER_FALLBACK = 'downscale'     # 超限时的回退方式：downscale（缩小的原始像素）或 placeholder（占位图）
+FALLBACK_MAX_SIZE = 512           # downscale 回退图的最大边长
+MEMORY_EXIT_CODE = 75             # 子进程内存不足时的退出码
+ERROR_EXIT_CODE = 76              # 子进程合成出错（非资源限制）时的退出码
+
+# 本次运行中触发合成限制的图层
+render_issues = []
+
+# 本次运行中被导出的图层（id），用于按选择集合成预览图
+exported_layer_ids = set()
+
+# 视觉指纹：感知哈希和缩略图，用于快速的视觉回归比较
+PHASH_SIZE = 32                   # 计算感知哈希前缩小到的边长
+THUMBNAIL_SIZE = 32               # 缩略图最大边长
+
+# 提取阶段注册表：阶段名 -> {"func", "layer_types", "enabled"}，按注册顺序执行
+EXTRACTOR_STAGES = {}
+
+# 各阶段的运行统计：阶段名 -> {"calls", "seconds"}
+STAGE_STATS = {}
+
+# 图层类型到内容类型的映射（用于按内容类型过滤）
+CONTENT_TYPES = {
+    "type": "text",
+    "pixel": "image",
+    "smartobject": "image",
+    "shape": "shape"
+}
+
 os.makedirs(ASSETS_DIR, exist_ok=True)
 
 def safe_filename(name):
     """生成安全的文件名"""
     return re.sub(r'[^\w\-_]', '_', name).strip()
 
+def effect_color(effect, effect_data):
+    """提取效果颜色并计入设计令牌"""
+    if hasattr(effect, 'color'):
+        color = effect.color
+        r, g, b = color.red, color.green, color.blue
+        effect_data["color"] = f"#{r:02x}{g:02x}{b:02x}"
+        design_tokens["colors"][f"#{r:02x}{g:02x}{b:02x}"] += 1
+
+@singledispatch
+def extract_effect(effect):
+    """
+    按效果类型提取单个图层效果，返回 (效果键, 效果数据)
+
+    未注册的效果类型返回 (None, None)；可通过 extract_effect.register 注册新的效果类型。
+    """
+    return None, None
+
+@extract_effect.register(psd_effects.DropShadow)
+@extract_effect.register(psd_effects.InnerShadow)
+def _extract_shadow(effect):
+    """阴影效果"""
+    effect_data = {
+        "enabled": getattr(effect, 'enabled', True),
+        "opacity": getattr(effect, 'opacity', 191) / 255.0,
+        "distance": getattr(effect, 'distance', 0),
+        "spread": getattr(effect, 'spread', 0),
+        "size": getattr(effect, 'size', 0),
+        "angle": getattr(effect, 'angle', 0),
+        "choke": getattr(effect, 'choke', 0)
+    }
+    effect_color(effect, effect_data)
+    return "shadow", effect_data
+
+@extract_effect.register(psd_effects.OuterGlow)
+@extract_effect.register(psd_effects.InnerGlow)
+def _extract_glow(effect):
+    """发光效果"""
+    effect_data = {
+        "enabled": getattr(effect, 'enabled', True),
+        "opacity": getattr(effect, 'opacity', 191) / 255.0,
+        "size": getattr(effect, 'size', 0),
+        "spread": getattr(effect, 'spread', 0)
+    }
+    effect_color(effect, effect_data)
+    return "glow", effect_data
+
+@extract_effect.register(psd_effects.Stroke)
+def _extract_stroke(effect):
+    """描边"""
+    effect_data = {
+        "enabled": getattr(effect, 'enabled', True),
+        "size": getattr(effect, 'size', 1),
+        "opacity": getattr(effect, 'opacity', 255) / 255.0,
+        "position": str(getattr(effect, 'position', 'center'))
+    }
+    effect_color(effect, effect_data)
+    return "stroke", effect_data
+
+@extract_effect.register(psd_effects.GradientOverlay)
+def _extract_gradient_overlay(effect):
+    """渐变叠加"""
+    return "gradient", {
+        "enabled": getattr(effect, 'enabled', True),
+        "opacity": getattr(effect, 'opacity', 255) / 255.0,
+        "angle": getattr(effect, 'angle', 0)
+    }
+
+@extract_effect.register(psd_effects.ColorOverlay)
+def _extract_color_overlay(effect):
+    """颜色叠加"""
+    return "color_overlay", {
+        "enabled": getattr(effect, 'enabled', True),
+        "opacity": getattr(effect, 'opacity', 255) / 255.0
+    }
+
+@extract_effect.register(psd_effects.BevelEmboss)
+def _extract_bevel(effect):
+    """斜面和浮雕"""
+    return "bevel", {
+        "enabled": getattr(effect, 'enabled', True),
+        "size": getattr(effect, 'size', 0),
+        "softness": getattr(effect, 'softness', 0),
+        "angle": getattr(effect, 'angle', 0),
+        "altitude": getattr(effect, 'altitude', 0)
+    }
+
 def extract_effects(layer):
-    """提取图层效果（阴影、内阴影、发光、浮雕等）"""
+    """提取图层效果（阴影、内阴影、发光、浮雕等），按效果类型分发"""
     effects = {}
     try:
         if hasattr(layer, 'effects') and layer.effects:
             for effect in layer.effects:
-                effect_name = effect.__class__.__name__
-                effect_data = {}
-
-                # 阴影效果
-                if 'DropShadow' in effect_name or 'InnerShadow' in effect_name:
-                    effect_data = {
-                        "enabled": getattr(effect, 'enabled', True),
-                        "opacity": getattr(effect, 'opacity', 191) / 255.0,
-                        "distance": getattr(effect, 'distance', 0),
-                        "spread": getattr(effect, 'spread', 0),
-                        "size": getattr(effect, 'size', 0),
-                        "angle": getattr(effect, 'angle', 0),
-                        "choke": getattr(effect, 'choke', 0)
-                    }
-                    # 提取阴影颜色
-                    if hasattr(effect, 'color'):
-                        color = effect.color
-                        r, g, b = color.red, color.green, color.blue
-                        effect_data["color"] = f"#{r:02x}{g:02x}{b:02x}"
-                        design_tokens["colors"].add(f"#{r:02x}{g:02x}{b:02x}")
-                    effects["shadow"] = effect_data
-
-                # 发光效果
-                elif 'OuterGlow' in effect_name or 'InnerGlow' in effect_name:
-                    effect_data = {
-                        "enabled": getattr(effect, 'enabled', True),
-                        "opacity": getattr(effect, 'opacity', 191) / 255.0,
-                        "size": getattr(effect, 'size', 0),
-                        "spread": getattr(effect, 'spread', 0)
-                    }
-                    if hasattr(effect, 'color'):
-                        color = effect.color
-                        r, g, b = color.red, color.green, color.blue
-                        effect_data["color"] = f"#{r:02x}{g:02x}{b:02x}"
-                        design_tokens["colors"].add(f"#{r:02x}{g:02x}{b:02x}")
-                    effects["glow"] = effect_data
-
-                # 描边
-                elif 'Stroke' in effect_name:
-                    effect_data = {
-                        "enabled": getattr(effect, 'enabled', True),
-                        "size": getattr(effect, 'size', 1),
-                        "opacity": getattr(effect, 'opacity', 255) / 255.0,
-                        "position": str(getattr(effect, 'position', 'center'))
-                    }
-                    # 提取描边颜色
-                    if hasattr(effect, 'color'):
-                        color = effect.color
-                        r, g, b = color.red, color.green, color.blue
-                        effect_data["color"] = f"#{r:02x}{g:02x}{b:02x}"
-                        design_tokens["colors"].add(f"#{r:02x}{g:02x}{b:02x}")
-                    effects["stroke"] = effect_data
-
-                # 渐变叠加
-                elif 'GradientOverlay' in effect_name:
-                    effect_data = {
-                        "enabled": getattr(effect, 'enabled', True),
-                        "opacity": getattr(effect, 'opacity', 255) / 255.0,
-                        "angle": getattr(effect, 'angle', 0)
-                    }
-                    effects["gradient"] = effect_data
-
-                # 颜色叠加
-                elif 'ColorOverlay' in effect_name:
-                    effect_data = {
-                        "enabled": getattr(effect, 'enabled', True),
-                        "opacity": getattr(effect, 'opacity', 255) / 255.0
-                    }
-                    effects["color_overlay"] = effect_data
-
-                # 斜面和浮雕
-                elif 'BevelEmboss' in effect_name:
-                    effect_data = {
-                        "enabled": getattr(effect, 'enabled', True),
-                        "size": getattr(effect, 'size', 0),
-                        "softness": getattr(effect, 'softness', 0),
-                        "angle": getattr(effect, 'angle', 0),
-                        "altitude": getattr(effect, 'altitude', 0)
-                    }
-                    effects["bevel"] = effect_data
+                key, effect_data = extract_effect(effect)
+                if key:
+                    effects[key] = effect_data
 
     except Exception as e:
         pass
@@ -168,7 +250,7 @@ def extract_text_styles(layer):
                 if font_size is not None:
                     font_size = float(font_size)
                     styles["font_size"] = font_size
-                    design_tokens["font_sizes"].add(round(font_size, 1))
+                    design_tokens["font_sizes"][round(font_size, 1)] += 1
 
                 # 颜色
                 if 'FillColor' in style:
@@ -181,14 +263,14 @@ def extract_text_styles(layer):
                             b = int(values[3] * 255 / 65535)
                             color_hex = f"#{r:02x}{g:02x}{b:02x}"
                             styles["color"] = color_hex
-                            design_tokens["colors"].add(color_hex)
+                            design_tokens["colors"][color_hex] += 1
 
                 # 字体样式
                 if 'Font' in style:
                     font_info = style['Font']
                     font_name = font_info.get('Name', 'Unknown')
                     styles["font_family"] = font_name
-                    design_tokens["fonts"].add(font_name)
+                    design_tokens["fonts"][font_name] += 1
 
                 # 字体粗细
                 auto_kern = style.get('AutoKern', True)
@@ -257,7 +339,7 @@ def extract_fill_info(layer):
                             avg_radius = sum(radius_values) / len(radius_values)
                             if avg_radius > 0:
                                 fill["border_radius"] = round(avg_radius, 1)
-                                design_tokens["spacings"].add(int(avg_radius))
+                                design_tokens["spacings"][int(avg_radius)] += 1
 
             # 提取描边样式
             if hasattr(mask, 'stroke_setting'):
@@ -274,14 +356,14 @@ def extract_fill_info(layer):
                         if hasattr(color, 'red') and hasattr(color, 'green') and hasattr(color, 'blue'):
                             r, g, b = color.red, color.green, color.blue
                             stroke_info["color"] = f"#{r:02x}{g:02x}{b:02x}"
-                            design_tokens["colors"].add(f"#{r:02x}{g:02x}{b:02x}")
+                            design_tokens["colors"][f"#{r:02x}{g:02x}{b:02x}"] += 1
 
                     # 提取描边类型（虚线、实线等）
                     if hasattr(stroke, 'stroke_style'):
                         stroke_info["style"] = str(stroke.stroke_style).lower()
 
                     fill["border"] = stroke_info
-                    design_tokens["spacings"].add(int(stroke_info["width"]))
+                    design_tokens["spacings"][int(stroke_info["width"])] += 1
 
         if hasattr(layer, 'resource_dict'):
             resources = layer.resource_dict
@@ -299,7 +381,7 @@ def extract_fill_info(layer):
                             b = int(values[2] * 255 / 65535)
                             color_hex = f"#{r:02x}{g:02x}{b:02x}"
                             fill["background_color"] = color_hex
-                            design_tokens["colors"].add(color_hex)
+                            design_tokens["colors"][color_hex] += 1
 
             # 渐变填充 - 提取完整渐变信息
             elif 'FillGradient' in resources:
@@ -333,7 +415,7 @@ def extract_fill_info(layer):
                                         "color": color_hex,
                                         "location": stop.get('Location', 0) / 4096.0
                                     })
-                                    design_tokens["colors"].add(color_hex)
+                                    design_tokens["colors"][color_hex] += 1
                         if stops:
                             gradient_info["color_stops"] = sorted(stops, key=lambda x: x['location'])
 
@@ -395,33 +477,430 @@ def optimize_image(img_path):
     except Exception as e:
         pass
 
-def parse_layer(layer, index_prefix="", parent_bbox=None):
-    """递归解析图层"""
-    if not layer.visible:
+def smartobject_cache_dir():
+    """智能对象缓存目录"""
+    return os.path.join(OUTPUT_DIR, SMARTOBJECT_CACHE_DIRNAME)
+
+def load_smartobject_cache():
+    """加载（或初始化）智能对象缓存索引"""
+    if smartobject_cache["index"] is None:
+        smartobject_cache["index"] = {}
+        index_file = os.path.join(smartobject_cache_dir(), 'index.json')
+        if os.path.exists(index_file):
+            try:
+                with open(index_file, 'r', encoding='utf-8') as f:
+                    smartobject_cache["index"] = json.load(f)
+            except Exception as e:
+                logger.warning(f"读取智能对象缓存索引失败，将重建缓存: {e}")
+    return smartobject_cache["index"]
+
+def save_smartobject_cache():
+    """保存智能对象缓存索引"""
+    if not smartobject_cache["index"]:
+        return
+    cache_dir = smartobject_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, 'index.json'), 'w', encoding='utf-8') as f:
+        json.dump(smartobject_cache["index"], f, indent=2, ensure_ascii=False)
+
+def is_axis_aligned(transform_box, tolerance=0.01):
+    """变换框是否只包含平移和正向缩放（没有旋转、斜切和翻转）"""
+    x1, y1, x2, y2, x3, y3, x4, y4 = transform_box
+    return (abs(x1 - x4) <= tolerance and abs(x2 - x3) <= tolerance
+            and abs(y1 - y2) <= tolerance and abs(y3 - y4) <= tolerance
+            and x2 > x1 and y4 > y1)
+
+def smartobject_cache_key(layer):
+    """
+    计算智能对象图层的缓存键
+
+    只有渲染结果仅取决于嵌入内容和放置大小的图层才可缓存：没有图层效果、智能滤镜、蒙版、
+    剪贴图层、变形、填充不透明度和混合颜色带（Blend If），变换框只含平移和正向缩放
+    （翻转、旋转的放置不缓存）。不可缓存时返回 None。
+    """
+    if layer.has_effects() or layer.has_mask() or layer.has_vector_mask() or layer.has_clip_layers():
+        return None
+    if layer.fill_opacity != 255 or layer._record.blending_ranges != LayerBlendingRanges():
         return None
+    for tag in (Tag.SMART_OBJECT_LAYER_DATA1, Tag.SMART_OBJECT_LAYER_DATA2):
+        config = layer.tagged_blocks.get_data(tag)
+        if config is not None and b'filterFX' in config.data:
+            return None
 
-    # 坐标信息
-    bbox = {
-        "left": int(layer.left),
-        "top": int(layer.top),
-        "width": int(layer.width),
-        "height": int(layer.height)
-    }
+    so = layer.smart_object
+    transform_box = so.transform_box
+    if transform_box is not None and not is_axis_aligned(transform_box):
+        return None
+    warp = so.warp
+    if warp is not None:
+        style = warp.get(b'warpStyle')
+        if style is not None and getattr(style, 'enum', style) != b'warpNone':
+            return None
 
-    data = {
-        "name": str(layer.name),
-        "kind": str(layer.kind),
-        "bbox": bbox
-    }
+    unique_id = so.unique_id
+    data_hash = smartobject_cache["data_hashes"].get(unique_id)
+    if data_hash is None:
+        try:
+            data_hash = hashlib.sha1(so.data).hexdigest()
+        except Exception:
+            # 链接的外部文件无法读取时，退化为文件名 + 大小
+            data_hash = hashlib.sha1(f"{so.filename}:{so.filesize}".encode('utf-8')).hexdigest()
+        smartobject_cache["data_hashes"][unique_id] = data_hash
+
+    key = hashlib.sha1(f"{unique_id}:{data_hash}:{layer.opacity}".encode('utf-8')).hexdigest()[:16]
+    return key, unique_id, data_hash
+
+def smartobject_cache_get(key, size):
+    """
+    查找缓存的渲染结果
+
+    只复用尺寸完全相同（放置位置不同）的渲染；尺寸不同时重新渲染，
+    不用缩放后的缓存代替 PSD 中的原始像素。未命中时返回 None。
+    """
+    entry = load_smartobject_cache().get(key)
+    if not entry:
+        return None
+
+    width, height = size
+    filename = entry["renders"].get(f"{width}x{height}")
+    if not filename:
+        return None
+    path = os.path.join(smartobject_cache_dir(), filename)
+    if not os.path.exists(path):
+        return None
+    with Image.open(path) as img:
+        image = img.copy()
+    smartobject_cache["stats"]["hits"] += 1
+    return image
+
+def smartobject_cache_put(key, unique_id, data_hash, image):
+    """将渲染结果写入缓存"""
+    cache_dir = smartobject_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+    width, height = image.size
+    filename = f"{key}_{width}x{height}.png"
+    image.save(os.path.join(cache_dir, filename))
+
+    entry = load_smartobject_cache().setdefault(key, {
+        "unique_id": unique_id,
+        "data_hash": data_hash,
+        "renders": {}
+    })
+    entry["renders"][f"{width}x{height}"] = filename
+
+class RenderLimitExceeded(Exception):
+    """图层合成超出时间或内存限制"""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+def _flatten_rgb(image):
+    """将图片合成到白色背景上，返回 RGB 图片"""
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1])
+        return background
+    return image.convert('RGB')
+
+def _dct_matrix(n):
+    """n 阶 DCT-II 变换矩阵"""
+    k = np.arange(n).reshape(-1, 1)
+    return np.cos(np.pi * (2 * np.arange(n) + 1) * k / (2 * n))
+
+def perceptual_hash(image):
+    """
+    计算 64 位感知哈希（pHash），以 16 位十六进制字符串表示
+
+    缩小为 PHASH_SIZE 灰度图后做二维 DCT，取左上角 8x8 低频系数与其中位数比较。
+    两张图哈希的汉明距离越小越相似，对编码器差异和轻微缩放不敏感。
+    """
+    gray = _flatten_rgb(image).convert('L').resize((PHASH_SIZE, PHASH_SIZE), Image.LANCZOS)
+    pixels = np.asarray(gray, dtype=np.float64)
+    dct = _dct_matrix(PHASH_SIZE)
+    # 舍入消除浮点误差，纯色图的交流系数全为 0，哈希稳定
+    low = np.round((dct @ pixels @ dct.T)[:8, :8].flatten(), 3)
+    # 直流分量只反映整体亮度，不参与中位数计算
+    bits = low > np.median(low[1:])
+    return f"{int(''.join('1' if b else '0' for b in bits), 2):016x}"
+
+def save_thumbnail(image, thumb_path):
+    """保存最大边长为 THUMBNAIL_SIZE 的 PNG 缩略图"""
+    thumb = image.copy()
+    thumb.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+    if thumb.mode not in ('RGB', 'RGBA'):
+        thumb = thumb.convert('RGBA')
+    os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+    thumb.save(thumb_path, format='PNG', optimize=True)
+
+def png_data_uri(png_path):
+    """读取 PNG 文件，返回 data URI；文件不存在时返回 None"""
+    if not os.path.exists(png_path):
+        return None
+    with open(png_path, 'rb') as f:
+        return "data:image/png;base64," + base64.b64encode(f.read()).decode('ascii')
+
+def composite_layer_inline(layer):
+    """在当前进程中合成单个图层"""
+    if layer.is_visible():
+        return layer.composite()
+    # 隐藏图层（或位于隐藏组中）需要强制合成自身
+    return layer.composite(layer_filter=lambda l: l is layer or l.visible)
+
+def _current_address_space():
+    """当前进程的虚拟内存大小（字节），无法获取（非 Linux）时返回 None"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[0]) * resource.getpagesize()
+    except Exception:
+        return None
+
+def memory_limit_supported():
+    """
+    当前平台能否对合成子进程施加内存上限
+
+    上限 = 当前虚拟内存 + RENDER_MEMORY_MB，需要从 /proc 读取当前虚拟内存；
+    macOS 不强制执行 RLIMIT_AS，设置了也不会生效。
+    """
+    if resource is None or not hasattr(resource, 'RLIMIT_AS') or sys.platform == 'darwin':
+        return False
+    return _current_address_space() is not None
+
+def _isolated_worker(render, result_path, memory_mb):
+    """子进程：在内存限制下执行 render() 并将结果保存到 result_path"""
+    try:
+        address_space = _current_address_space() if memory_mb else None
+        if address_space is not None:
+            limit = address_space + memory_mb * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, resource.getrlimit(resource.RLIMIT_AS)[1]))
+        image = render()
+        if image:
+            image.save(result_path, format='PNG')
+    except MemoryError:
+        os._exit(MEMORY_EXIT_CODE)
+    except Exception as e:
+        # 普通的合成错误：把错误信息交给父进程，不打印堆栈
+        try:
+            with open(result_path + '.error', 'w', encoding='utf-8') as f:
+                f.write(f"{type(e).__name__}: {e}")
+        except Exception:
+            pass
+        os._exit(ERROR_EXIT_CODE)
+
+def run_isolated(render, timeout=None, memory_mb=None):
+    """
+    在 fork 出的子进程中执行 render()，返回其生成的图片
+
+    子进程继承父进程中已解析的 PSD，因此无需序列化图层；结果以 PNG 临时文件传回。
+    超出时间或内存限制时抛出 RenderLimitExceeded；render() 自身出错时抛出 RuntimeError。
+    """
+    fd, result_path = tempfile.mkstemp(suffix='.png')
+    os.close(fd)
+    os.remove(result_path)
+    error_path = result_path + '.error'
+    try:
+        proc = multiprocessing.get_context('fork').Process(
+            target=_isolated_worker, args=(render, result_path, memory_mb), daemon=True)
+        proc.start()
+        proc.join(timeout)
+        if proc.is_alive():
+            proc.kill()
+            proc.join()
+            raise RenderLimitExceeded("timeout")
+        if proc.exitcode == MEMORY_EXIT_CODE:
+            raise RenderLimitExceeded("memory")
+        if proc.exitcode == ERROR_EXIT_CODE:
+            message = "未知错误"
+            if os.path.exists(error_path):
+                with open(error_path, 'r', encoding='utf-8') as f:
+                    message = f.read()
+            raise RuntimeError(f"子进程合成失败: {message}")
+        if proc.exitcode != 0:
+            # 被信号终止（如系统 OOM killer 或段错误）
+            raise RenderLimitExceeded("memory" if memory_mb else "crashed")
+        if not os.path.exists(result_path):
+            return None
+        with Image.open(result_path) as img:
+            return img.copy()
+    finally:
+        for path in (result_path, error_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+def composite_layer_isolated(layer, timeout=None, memory_mb=None):
+    """在受限子进程中合成图层，见 run_isolated"""
+    return run_isolated(lambda: composite_layer_inline(layer), timeout, memory_mb)
+
+def render_limits_enabled():
+    """是否设置了合成限制且当前平台支持在受限子进程中合成"""
+    if not (RENDER_TIMEOUT or RENDER_MEMORY_MB):
+        return False
+    if resource is None or 'fork' not in multiprocessing.get_all_start_methods():
+        logger.warning("当前平台不支持 fork 或资源限制，图层合成限制不生效")
+        return False
+    return True
+
+def composite_layer(layer):
+    """合成单个图层；设置了时间或内存限制时在子进程中合成"""
+    if not render_limits_enabled():
+        return composite_layer_inline(layer)
+    return composite_layer_isolated(layer, RENDER_TIMEOUT, RENDER_MEMORY_MB)
+
+def _downscaled_preview(psd):
+    """读取文件内嵌的合成预览（不做合成）并缩小到 FALLBACK_MAX_SIZE 以内"""
+    image = psd.topil()
+    if image:
+        image.thumbnail((FALLBACK_MAX_SIZE, FALLBACK_MAX_SIZE))
+    return image
+
+def render_preview(psd, layer_filter=None):
+    """
+    生成整体预览图
+
+    设置了合成限制时与图层一样在受限子进程中合成；超限时按 RENDER_FALLBACK
+    回退为缩小的内嵌预览或占位图，并记录到 render_issues。
+    """
+    if not render_limits_enabled():
+        return psd.composite(layer_filter=layer_filter)
+    try:
+        return run_isolated(lambda: psd.composite(layer_filter=layer_filter),
+                            RENDER_TIMEOUT, RENDER_MEMORY_MB)
+    except RenderLimitExceeded as e:
+        image, fallback = None, 'placeholder'
+        if RENDER_FALLBACK == 'downscale' and e.reason != 'memory':
+            try:
+                image = run_isolated(lambda: _downscaled_preview(psd), RENDER_TIMEOUT, RENDER_MEMORY_MB)
+                fallback = 'downscale'
+            except Exception as err:
+                logger.debug(f"读取内嵌预览图时出错: {err}")
+        if not image:
+            image, fallback = Image.new('RGB', (int(psd.width), int(psd.height)), (204, 204, 204)), 'placeholder'
+        render_issues.append({
+            "path": "full_preview.png",
+            "reason": e.reason,
+            "fallback": fallback
+        })
+        logger.warning(f"整体预览图合成超限（{e.reason}），使用 {fallback} 回退")
+        return image
+
+def _downscaled_pixels(layer):
+    """读取图层自身的原始像素并缩小到 FALLBACK_MAX_SIZE 以内"""
+    image = layer.topil()
+    if image:
+        image.thumbnail((FALLBACK_MAX_SIZE, FALLBACK_MAX_SIZE))
+    return image
+
+def fallback_render(layer, reason):
+    """
+    合成超限时的回退渲染
+
+    downscale 使用图层自身的原始像素（不含效果和剪贴，不做合成）并缩小到
+    FALLBACK_MAX_SIZE 以内，同样在受限子进程中读取；因内存超限、读取失败或再次超限时，
+    退化为与图层等大的灰色占位图。
+
+    Returns:
+        (image, 实际使用的回退方式)
+    """
+    if RENDER_FALLBACK == 'downscale' and reason != 'memory':
+        try:
+            image = run_isolated(lambda: _downscaled_pixels(layer), RENDER_TIMEOUT, RENDER_MEMORY_MB)
+            if image:
+                return image, 'downscale'
+        except Exception as e:
+            logger.debug(f"读取图层 '{layer.name}' 的原始像素时出错: {e}")
+    size = (max(int(layer.width), 1), max(int(layer.height), 1))
+    return Image.new('RGBA', size, (204, 204, 204, 255)), 'placeholder'
+
+def render_layer(layer):
+    """合成图层；可缓存的智能对象图层优先复用缓存的渲染结果"""
+    if not (SMARTOBJECT_CACHE and isinstance(layer, SmartObjectLayer)):
+        return composite_layer(layer)
 
-    # 收集间距信息：提取有意义的间距值
+    try:
+        cache_key = smartobject_cache_key(layer)
+    except Exception as e:
+        logger.debug(f"计算智能对象 '{layer.name}' 的缓存键时出错: {e}")
+        cache_key = None
+    if cache_key is None:
+        return composite_layer(layer)
+
+    key, unique_id, data_hash = cache_key
+    image = smartobject_cache_get(key, (int(layer.width), int(layer.height)))
+    if image is not None:
+        return image
+
+    smartobject_cache["stats"]["misses"] += 1
+    image = composite_layer(layer)
+    if image:
+        smartobject_cache_put(key, unique_id, data_hash, image)
+    return image
+
+def register_stage(name, layer_types=None, enabled=True):
+    """
+    注册提取阶段（装饰器）
+
+    阶段函数签名为 func(layer, data, context)，直接修改 data；
+    context 包含 index_prefix、parent_bbox 和 path。
+
+    Args:
+        name: 阶段名，重复注册会覆盖同名阶段
+        layer_types: 适用的图层类（如 (PixelLayer, SmartObjectLayer)），None 表示所有图层
+        enabled: 是否默认启用
+    """
+    def decorator(func):
+        EXTRACTOR_STAGES[name] = {
+            "func": func,
+            "layer_types": tuple(layer_types) if layer_types else None,
+            "enabled": enabled
+        }
+        STAGE_STATS.setdefault(name, {"calls": 0, "seconds": 0.0})
+        return func
+    return decorator
+
+def set_stage_enabled(name, enabled=True):
+    """启用或禁用提取阶段"""
+    if name not in EXTRACTOR_STAGES:
+        raise ValueError(f"未知的提取阶段: {name}（可用: {', '.join(EXTRACTOR_STAGES)}）")
+    EXTRACTOR_STAGES[name]["enabled"] = enabled
+
+def run_stages(layer, data, context):
+    """按注册顺序对图层运行所有已启用且适用的提取阶段，并记录调用次数和耗时"""
+    for name, stage in EXTRACTOR_STAGES.items():
+        if not stage["enabled"]:
+            continue
+        if stage["layer_types"] and not isinstance(layer, stage["layer_types"]):
+            continue
+        start = time.perf_counter()
+        try:
+            stage["func"](layer, data, context)
+        except Exception as e:
+            logger.debug(f"阶段 {name} 处理图层 '{layer.name}' 时出错: {e}")
+        finally:
+            stats = STAGE_STATS[name]
+            stats["calls"] += 1
+            stats["seconds"] += time.perf_counter() - start
+
+def format_stage_stats():
+    """格式化各阶段的运行统计"""
+    lines = []
+    for name, stage in EXTRACTOR_STAGES.items():
+        stats = STAGE_STATS[name]
+        state = "" if stage["enabled"] else " (已禁用)"
+        lines.append(f"   - {name}: {stats['calls']} 次, {stats['seconds']:.3f}s{state}")
+    return "\n".join(lines)
+
+@register_stage("spacing")
+def stage_spacing(layer, data, context):
+    """收集间距信息：图层边界，以及相对父容器的内边距"""
     # 1. 提取图层的左、上、右、下边界
-    design_tokens["spacings"].add(int(layer.left))
-    design_tokens["spacings"].add(int(layer.top))
-    design_tokens["spacings"].add(int(layer.width))
-    design_tokens["spacings"].add(int(layer.height))
+    design_tokens["spacings"][int(layer.left)] += 1
+    design_tokens["spacings"][int(layer.top)] += 1
+    design_tokens["spacings"][int(layer.width)] += 1
+    design_tokens["spacings"][int(layer.height)] += 1
 
     # 2. 如果有父容器，计算内边距和外边距
+    parent_bbox = context["parent_bbox"]
     if parent_bbox:
         # 计算相对父容器的内边距
         padding_left = int(layer.left - parent_bbox["left"])
@@ -431,98 +910,260 @@ def parse_layer(layer, index_prefix="", parent_bbox=None):
 
         # 只收集正值的内边距
         if padding_left >= 0:
-            design_tokens["spacings"].add(padding_left)
+            design_tokens["spacings"][padding_left] += 1
         if padding_top >= 0:
-            design_tokens["spacings"].add(padding_top)
+            design_tokens["spacings"][padding_top] += 1
         if padding_right >= 0:
-            design_tokens["spacings"].add(padding_right)
+            design_tokens["spacings"][padding_right] += 1
         if padding_bottom >= 0:
-            design_tokens["spacings"].add(padding_bottom)
+            design_tokens["spacings"][padding_bottom] += 1
 
-    # 3. 提取圆角（如果有的话）
+@register_stage("corner_radius")
+def stage_corner_radius(layer, data, context):
+    """从矢量蒙版中收集圆角"""
     if hasattr(layer, 'vector_mask') and layer.vector_mask:
         mask = layer.vector_mask
         if hasattr(mask, 'paths'):
-            for path in mask.paths:
-                if hasattr(path, 'corners') and path.corners:
-                    for corner in path.corners:
+            for mask_path in mask.paths:
+                if hasattr(mask_path, 'corners') and mask_path.corners:
+                    for corner in mask_path.corners:
                         if hasattr(corner, 'radius'):
                             radius = int(corner.radius)
                             if radius > 0:
-                                design_tokens["spacings"].add(radius)
+                                design_tokens["spacings"][radius] += 1
 
-    # 提取混合模式和透明度
+@register_stage("blend")
+def stage_blend(layer, data, context):
+    """提取混合模式和透明度"""
     blend_info = extract_blend_info(layer)
     if blend_info:
         data["blend"] = blend_info
 
-    # 提取图层效果
+@register_stage("effects")
+def stage_effects(layer, data, context):
+    """提取图层效果"""
     effects = extract_effects(layer)
     if effects:
         data["effects"] = effects
 
-    # 1. 处理文字图层
-    if layer.kind == 'type':
-        data["content_type"] = "text"
-        data["text"] = layer.text
-
-        text_styles = extract_text_styles(layer)
-        if text_styles:
-            data.update(text_styles)
-
-        # 组件识别
-        component_type = detect_component_type(layer.name)
-        if component_type:
-            data["componentType"] = component_type
-
-    # 2. 处理图片图层
-    elif layer.kind == 'pixel' or layer.kind == 'smartobject':
-        data["content_type"] = "image"
-        safe_name = safe_filename(layer.name)
-        img_filename = f"{index_prefix}_{safe_name}.png"
-        img_path = os.path.join(ASSETS_DIR, img_filename)
+@register_stage("text_styles", layer_types=(TypeLayer,))
+def stage_text_styles(layer, data, context):
+    """提取文字样式"""
+    text_styles = extract_text_styles(layer)
+    if text_styles:
+        data.update(text_styles)
+
+@register_stage("export", layer_types=(PixelLayer, SmartObjectLayer))
+def stage_export(layer, data, context):
+    """合成并导出图片资源"""
+    safe_name = safe_filename(layer.name)
+    img_filename = f"{context['index_prefix']}_{safe_name}.png"
+    img_path = os.path.join(ASSETS_DIR, img_filename)
+
+    fallback = None
+    try:
+        image = render_layer(layer)
+    except RenderLimitExceeded as e:
+        image, fallback = fallback_render(layer, e.reason)
+        data["render_fallback"] = {"reason": e.reason, "fallback": fallback}
+        render_issues.append({
+            "path": context["path"],
+            "reason": e.reason,
+            "fallback": fallback
+        })
+        logger.warning(f"图层 '{context['path']}' 合成超限（{e.reason}），使用 {fallback} 回退")
+
+    if image:
+        image.save(img_path)
+        optimize_image(img_path)
+        data["src"] = f"assets/{img_filename}"
+        if not fallback:
+            # 供后续阶段（如 fingerprint）复用内存中的合成图
+            context["image"] = image
+            if SAMPLE_PIXEL_COLORS:
+                sample_pixel_colors(image)
+
+@register_stage("fingerprint", layer_types=(PixelLayer, SmartObjectLayer))
+def stage_fingerprint(layer, data, context):
+    """基于内存中的合成图计算感知哈希，缩略图保存到 assets/thumbs/ 下"""
+    image = context.get("image")
+    if image is None:
+        return
+    data["phash"] = perceptual_hash(image)
+    thumb_filename = f"{context['index_prefix']}.png"
+    save_thumbnail(image, os.path.join(ASSETS_DIR, 'thumbs', thumb_filename))
+    data["thumbnail"] = f"assets/thumbs/{thumb_filename}"
 
-        try:
-            image = layer.composite()
-            if image:
-                image.save(img_path)
-                optimize_image(img_path)
-                data["src"] = f"assets/{img_filename}"
-        except Exception as e:
-            pass
+@register_stage("fill", layer_types=(PixelLayer, SmartObjectLayer, ShapeLayer))
+def stage_fill(layer, data, context):
+    """提取填充信息"""
+    fill_info = extract_fill_info(layer)
+    if fill_info:
+        data["styles"] = fill_info
+
+def make_layer_filter(include=None, exclude=None, component_types=None,
+                      content_types=None, include_hidden=False):
+    """
+    创建图层过滤器
+
+    Args:
+        include: 图层路径 glob 列表（如 "首页/header"），匹配的图层及其整个子树被导出。
+                 路径格式见 split_layers.sibling_paths：图层名中的 %、/、# 需转义，
+                 同名兄弟图层的第 n 个写作 "名称#n"
+        exclude: 图层路径 glob 列表，匹配的图层及其子树被跳过
+        component_types: 组件类型列表（button、card 等），匹配的图层及其子树被导出
+        content_types: 内容类型列表（text、image、shape），只导出这些类型的叶子图层
+        include_hidden: 是否导出隐藏图层
+    """
+    return {
+        "include": list(include or []),
+        "exclude": list(exclude or []),
+        "component_types": set(component_types or []),
+        "content_types": set(content_types or []),
+        "include_hidden": include_hidden
+    }
 
-        # 组件识别
-        component_type = detect_component_type(layer.name)
-        if component_type:
-            data["componentType"] = component_type
+def layer_content_type(layer):
+    """根据图层类型推断内容类型"""
+    if layer.is_group():
+        return "container"
+    return CONTENT_TYPES.get(layer.kind)
+
+def could_match_descendant(path, pattern):
+    """判断 pattern 是否可能匹配 path 的某个后代路径（保守判断，不会误剪枝）"""
+    path_parts = path.split('/')
+    pattern_parts = pattern.split('/')
+    for i, part in enumerate(path_parts):
+        if i >= len(pattern_parts):
+            # 通配符可以跨越 "/"，无法确定时不剪枝
+            return '*' in pattern_parts[-1]
+        if fnmatchcase(part, pattern_parts[i]):
+            continue
+        return '*' in pattern_parts[i]
+    return len(pattern_parts) > len(path_parts)
+
+def filter_layer(layer_filter, path, layer, inherited):
+    """
+    对单个图层应用过滤器（在任何合成之前调用）
+
+    Args:
+        layer_filter: make_layer_filter 创建的过滤器
+        path: 图层路径
+        layer: psd-tools 图层对象
+        inherited: 父图层的匹配状态
+
+    Returns:
+        图层的匹配状态（传递给子图层）；返回 None 表示跳过整个子树。
+        对叶子图层，返回非 None 即表示该图层被选中。
+    """
+    if not layer.visible and not layer_filter["include_hidden"]:
+        return None
+    if any(fnmatchcase(path, pattern) for pattern in layer_filter["exclude"]):
+        return None
 
-        # 提取填充信息
-        fill_info = extract_fill_info(layer)
-        if fill_info:
-            data["styles"] = fill_info
+    include = layer_filter["include"]
+    component_types = layer_filter["component_types"]
+    state = {
+        "path": inherited["path"] or not include
+                or any(fnmatchcase(path, pattern) for pattern in include),
+        "component": inherited["component"] or not component_types
+                     or detect_component_type(layer.name) in component_types
+    }
 
-    # 3. 处理形状图层
-    elif layer.kind == 'shape':
-        data["content_type"] = "shape"
+    if layer.is_group():
+        # 组本身未命中时，只有后代可能命中才继续向下遍历
+        if not state["path"] and not any(could_match_descendant(path, p) for p in include):
+            return None
+        return state
 
-        # 提取填充
-        fill_info = extract_fill_info(layer)
-        if fill_info:
-            data["styles"] = fill_info
+    if not (state["path"] and state["component"]):
+        return None
+    content_types = layer_filter["content_types"]
+    if content_types and layer_content_type(layer) not in content_types:
+        return None
+    return state
+
+def select_structure(nodes, selection_index):
+    """从解析结果中提取某个选择集的图层树（组只在包含选中的子图层时保留）"""
+    selected = []
+    for node in nodes:
+        if "children" in node:
+            children = select_structure(node["children"], selection_index)
+            if not children:
+                continue
+            node = {k: (children if k == "children" else v)
+                    for k, v in node.items() if k != "_selections"}
+        elif selection_index in node.get("_selections", ()):
+            node = {k: v for k, v in node.items() if k != "_selections"}
+        else:
+            continue
+        selected.append(node)
+    return selected
+
+def parse_layer(layer, index_prefix="", parent_bbox=None, path=None,
+                selections=None, states=None):
+    """
+    递归解析图层
+
+    path 为图层的唯一路径（见 split_layers.sibling_paths），记录在图层数据中，
+    并用于过滤、合成问题记录和视觉指纹；selections 为过滤器列表，states 为与之对应的
+    父图层匹配状态；被所有过滤器跳过的图层直接返回 None，不做任何合成。
+    """
+    if selections is None:
+        selections = [make_layer_filter()]
+    if states is None:
+        states = [{"path": False, "component": False}] * len(selections)
+
+    if path is None:
+        path = sibling_paths([layer.name])[0]
+    states = [
+        filter_layer(layer_filter, path, layer, state) if state is not None else None
+        for layer_filter, state in zip(selections, states)
+    ]
+    if all(state is None for state in states):
+        return None
 
-        component_type = detect_component_type(layer.name)
-        if component_type:
-            data["componentType"] = component_type
+    # 坐标信息
+    bbox = {
+        "left": int(layer.left),
+        "top": int(layer.top),
+        "width": int(layer.width),
+        "height": int(layer.height)
+    }
 
-    # 4. 处理组
-    elif layer.is_group():
-        data["content_type"] = "container"
+    data = {
+        "name": str(layer.name),
+        "path": path,
+        "kind": str(layer.kind),
+        "bbox": bbox
+    }
+    if not layer.visible:
+        data["visible"] = False
+    if not layer.is_group():
+        data["_selections"] = [i for i, state in enumerate(states) if state is not None]
+
+    # 运行提取阶段（间距、圆角、混合模式、效果、文字样式、切图、填充等）
+    content_type = layer_content_type(layer)
+    if content_type:
+        data["content_type"] = content_type
+    if layer.kind == 'type':
+        data["text"] = layer.text
+    run_stages(layer, data, {
+        "index_prefix": index_prefix,
+        "parent_bbox": parent_bbox,
+        "path": path
+    })
+
+    # 处理组
+    if layer.is_group():
         children_data = []
 
         child_layers = list(layer)
         child_count = len(child_layers)
-        for i, child in enumerate(child_layers):
-            child_result = parse_layer(child, f"{index_prefix}_{i}", bbox)
+        child_paths = sibling_paths([child.name for child in child_layers], path)
+        for i, (child, child_path) in enumerate(zip(child_layers, child_paths)):
+            child_result = parse_layer(child, f"{index_prefix}_{i}", bbox,
+                                       child_path, selections, states)
             if child_result:
                 # 添加子图层的 zIndex（倒序）
                 child_result["zIndex"] = child_count - i
@@ -546,60 +1187,368 @@ def parse_layer(layer, index_prefix="", parent_bbox=None):
         else:
             return None
 
+    # 组件识别（文字、图片、形状图层）
+    elif content_type:
+        component_type = detect_component_type(layer.name)
+        if component_type:
+            data["componentType"] = component_type
+
+    exported_layer_ids.add(id(layer))
     return data
 
+def hex_to_rgb_array(hex_colors):
+    """将 #rrggbb 颜色列表转换为 (n, 3) 的 RGB 数组"""
+    values = [int(c.lstrip('#')[:6], 16) for c in hex_colors]
+    packed = np.array(values, dtype=np.uint32).reshape(-1, 1)
+    shifts = np.array([16, 8, 0], dtype=np.uint32)
+    return ((packed >> shifts) & 0xff).astype(np.float64)
+
+def rgb_to_lab(rgb):
+    """将 (n, 3) 的 sRGB 数组（0-255）转换为 CIELAB（D65）"""
+    c = rgb / 255.0
+    linear = np.where(c > 0.04045, ((c + 0.055) / 1.055) ** 2.4, c / 12.92)
+    matrix = np.array([
+        [0.4124564, 0.3575761, 0.1804375],
+        [0.2126729, 0.7151522, 0.0721750],
+        [0.0193339, 0.1191920, 0.9503041]
+    ])
+    xyz = linear @ matrix.T / np.array([0.95047, 1.0, 1.08883])
+    f = np.where(xyz > (6 / 29) ** 3, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+    return np.stack([
+        116 * f[:, 1] - 16,
+        500 * (f[:, 0] - f[:, 1]),
+        200 * (f[:, 1] - f[:, 2])
+    ], axis=1)
+
+def cluster_colors(color_counts, threshold=COLOR_CLUSTER_DISTANCE, limit=MAX_TOKENS):
+    """
+    在 Lab 空间中按出现次数聚类颜色
+
+    从出现次数最多的颜色开始，把距离在 threshold 内的未归类颜色并入该簇，
+    以簇中出现最多的颜色作为代表色。返回按使用次数降序排列的颜色令牌。
+    """
+    if not color_counts:
+        return []
+
+    hex_colors = list(color_counts)
+    counts = np.array([color_counts[c] for c in hex_colors], dtype=np.int64)
+    lab = rgb_to_lab(hex_to_rgb_array(hex_colors))
+
+    # remaining 始终按出现次数降序排列，每轮以第一个颜色为种子并移除已归类的颜色
+    remaining = np.argsort(-counts, kind='stable')
+    clusters = []
+    while len(remaining):
+        seed = remaining[0]
+        distances = ((lab[remaining] - lab[seed]) ** 2).sum(axis=1)
+        in_cluster = distances <= threshold ** 2
+        members = remaining[in_cluster]
+        clusters.append({
+            "value": hex_colors[seed],
+            "count": int(counts[members].sum()),
+            "variants": int(len(members))
+        })
+        remaining = remaining[~in_cluster]
+
+    clusters.sort(key=lambda c: c["count"], reverse=True)
+    return clusters[:limit]
+
+def sample_pixel_colors(image):
+    """从合成图中采样颜色，量化到每通道 16 级后计入 pixel_colors"""
+    try:
+        img = image.convert('RGBA')
+        img.thumbnail((PIXEL_SAMPLE_SIZE, PIXEL_SAMPLE_SIZE))
+        pixels = np.asarray(img).reshape(-1, 4)
+        # 忽略大部分透明的像素
+        pixels = pixels[pixels[:, 3] >= 128, :3].astype(np.uint32) >> 4
+        if not len(pixels):
+            return
+        keys, counts = np.unique((pixels[:, 0] << 8) | (pixels[:, 1] << 4) | pixels[:, 2],
+                                 return_counts=True)
+        # 每通道 0-15 映射回 0-255（乘以 17），保证纯白、纯黑不偏移
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            r, g, b = ((key >> 8) & 0xf) * 17, ((key >> 4) & 0xf) * 17, (key & 0xf) * 17
+            design_tokens["pixel_colors"][f"#{r:02x}{g:02x}{b:02x}"] += count
+    except Exception as e:
+        logger.debug(f"采样像素颜色时出错: {e}")
+
+def detect_spacing_grid(spacing_counts):
+    """检测间距网格：返回候选网格中第一个覆盖足够多间距的值，检测不到时返回 None"""
+    if not spacing_counts:
+        return None
+    values = np.array(list(spacing_counts), dtype=np.int64)
+    counts = np.array(list(spacing_counts.values()), dtype=np.int64)
+    total = counts.sum()
+    for grid in SPACING_GRIDS:
+        share = counts[values % grid == 0].sum() / total
+        if share >= SPACING_GRID_MIN_SHARE:
+            return grid
+    return None
+
+def snap_spacings(spacing_counts, grid, limit=MAX_TOKENS, max_value=SPACING_MAX):
+    """
+    将间距吸附到网格上并合并计数，返回按使用次数降序排列的间距令牌
+
+    四舍五入到最近的网格值（正好在中间时向上取）；小于半个网格的值
+    （如 1-3px 的描边、圆角）保持原值，不吸附。吸附结果不超过 max_value
+    以内最大的网格值。
+    """
+    if not spacing_counts:
+        return []
+    snapped = Counter()
+    for value, count in spacing_counts.items():
+        if grid and value >= grid / 2:
+            value = min(int(value / grid + 0.5) * grid, max_value // grid * grid)
+        snapped[value] += count
+    return [{"value": v, "count": c} for v, c in snapped.most_common(limit)]
+
 def extract_design_tokens():
-    """整理设计令牌"""
-    # 过滤和排序颜色
-    colors = sorted(list(design_tokens["colors"]))
-
-    # 分析常用间距 - 只保留有意义的间距值
-    spacings = sorted(list(design_tokens["spacings"]))
-    # 过滤：去除0和过大的值，保留设计中常用的间距
-    common_spacings = sorted(set([
-        s for s in spacings
-        if 0 < s < 500  # 排除过大值
-    ]))
-
-    # 提取常见的设计间距（8的倍数或4的倍数）
-    design_spacings = []
-    for s in common_spacings:
-        # 常用的间距值：4, 8, 12, 16, 20, 24, 32, 40, 48, 56, 64, 80, 96等
-        if s <= 100:
-            design_spacings.append(s)
-
-    # 分析字体大小
-    font_sizes = sorted(list(design_tokens["font_sizes"]))
+    """整理设计令牌（按使用次数排序，每个令牌附带使用次数）"""
+    # 分析常用间距 - 只保留设计中常用的间距值（排除 0 和过大的值）
+    common_spacings = Counter({
+        s: c for s, c in design_tokens["spacings"].items()
+        if 0 < s <= SPACING_MAX
+    })
+    grid = detect_spacing_grid(common_spacings)
+
+    tokens = {
+        "colors": cluster_colors(design_tokens["colors"]),
+        "fonts": [{"value": f, "count": c} for f, c in design_tokens["fonts"].most_common()],
+        "font_sizes": [{"value": s, "count": c} for s, c in design_tokens["font_sizes"].most_common()],
+        "spacing_grid": grid,
+        "spacings": snap_spacings(common_spacings, grid)
+    }
+    if SAMPLE_PIXEL_COLORS:
+        tokens["pixel_colors"] = cluster_colors(design_tokens["pixel_colors"])
+    return tokens
+
+def collect_fingerprints(nodes):
+    """
+    收集所有带感知哈希的图层：[{path, src, phash, thumbnail}]
+
+    path 为解析时记录的唯一路径；图层数据中的 thumbnail 是缩略图文件路径，
+    索引中内联为 data URI，使 compare_layers.py 只读索引即可比较颜色变化。
+    """
+    fingerprints = []
+    for node in nodes:
+        if node.get("phash"):
+            thumbnail = node.get("thumbnail")
+            fingerprints.append({
+                "path": node["path"],
+                "src": node.get("src"),
+                "phash": node["phash"],
+                "thumbnail": png_data_uri(os.path.join(OUTPUT_DIR, thumbnail)) if thumbnail else None
+            })
+        fingerprints.extend(collect_fingerprints(node.get("children", [])))
+    return fingerprints
+
+def write_outputs(psd, structure, tokens, suffix=""):
+    """
+    写出 layout_data{suffix}.json、layers{suffix}/ 下的单图层文件和索引
+
+    Returns:
+        (json_path, layers_dir)
+    """
+    json_path = os.path.join(OUTPUT_DIR, f'layout_data{suffix}.json')
+    output_data = {
+        "metadata": {
+            "design_width": int(psd.width),
+            "design_height": int(psd.height),
+            "generated_at": datetime.now().isoformat(),
+            "psd_file": PSD_FILE,
+            "total_layers": len(structure),
+            "render_issues": render_issues
+        },
+        "design_tokens": tokens,
+        "layers": structure
+    }
 
-    return {
-        "colors": colors[:20],  # 最多20个主要颜色
-        "fonts": list(design_tokens["fonts"]),
-        "font_sizes": font_sizes,
-        "spacings": design_spacings[:20]  # 最多20个常用间距
+    logger.info(f"保存元数据和图层结构到 {json_path}")
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump(output_data, f, indent=2, ensure_ascii=False)
+
+    # 拆分每个图层为独立的 JSON 文件
+    logger.info("正在拆分图层为独立文件...")
+    layers_dir = os.path.join(OUTPUT_DIR, f'layers{suffix}')
+    os.makedirs(layers_dir, exist_ok=True)
+
+    for i, layer_data in enumerate(structure):
+        layer_name = safe_filename(layer_data.get("name", f"layer_{i}"))
+        layer_file = os.path.join(layers_dir, f"{i}_{layer_name}.json")
+
+        layer_output = {
+            "metadata": {
+                "design_width": int(psd.width),
+                "design_height": int(psd.height),
+                "generated_at": datetime.now().isoformat(),
+                "psd_file": PSD_FILE,
+                "layer_index": i,
+                "layer_name": layer_data.get("name")
+            },
+            "design_tokens": tokens,
+            "layer": layer_data
+        }
+
+        with open(layer_file, 'w', encoding='utf-8') as f:
+            json.dump(layer_output, f, indent=2, ensure_ascii=False)
+
+    # 生成图层索引文件
+    index_file = os.path.join(layers_dir, "index.json")
+    layer_index = {
+        "total_layers": len(structure),
+        "layers": [
+            {
+                "index": i,
+                "name": layer.get("name"),
+                "file": f"{i}_{safe_filename(layer.get('name', f'layer_{i}'))}.json"
+            }
+            for i, layer in enumerate(structure)
+        ],
+        "fingerprints": collect_fingerprints(structure)
     }
+    with open(index_file, 'w', encoding='utf-8') as f:
+        json.dump(layer_index, f, indent=2, ensure_ascii=False)
+
+    return json_path, layers_dir
+
+def reset_run_state():
+    """
+    清空上一次运行留下的模块级状态（设计令牌、导出图层、合成问题、缓存索引和阶段统计），
+    使同一进程中多次调用 main() 互不影响
+    """
+    for counter in design_tokens.values():
+        counter.clear()
+    exported_layer_ids.clear()
+    render_issues.clear()
+    smartobject_cache["index"] = None
+    smartobject_cache["data_hashes"].clear()
+    smartobject_cache["stats"].clear()
+    for stats in STAGE_STATS.values():
+        stats["calls"] = 0
+        stats["seconds"] = 0.0
+
+def parse_selection(value):
+    """解析 --selection 参数：NAME=GLOB[,GLOB...]"""
+    name, sep, patterns = value.partition('=')
+    if not sep or not name or not patterns:
+        raise argparse.ArgumentTypeError(f"选择集格式应为 NAME=GLOB[,GLOB...]: {value}")
+    return name, [p for p in patterns.split(',') if p]
+
+def parse_args(argv=None):
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description='将 PSD 转换为图层结构、设计令牌和切图')
+    parser.add_argument('--psd', default=PSD_FILE, help='PSD 文件路径')
+    parser.add_argument('--output', default=OUTPUT_DIR, help='输出目录')
+    parser.add_argument('--include', action='append', default=[], metavar='GLOB',
+                        help='只导出匹配该图层路径的子树（如 "首页/header"），可重复')
+    parser.add_argument('--exclude', action='append', default=[], metavar='GLOB',
+                        help='跳过匹配该图层路径的子树，可重复')
+    parser.add_argument('--component', action='append', default=[],
+                        choices=sorted(COMPONENT_PATTERNS),
+                        help='只导出该组件类型的子树，可重复')
+    parser.add_argument('--content', action='append', default=[],
+                        choices=sorted(set(CONTENT_TYPES.values())),
+                        help='只导出该内容类型的图层，可重复')
+    parser.add_argument('--include-hidden', action='store_true', help='同时导出隐藏图层')
+    parser.add_argument('--selection', action='append', default=[], type=parse_selection,
+                        metavar='NAME=GLOB[,GLOB...]',
+                        help='额外的命名选择集，一次遍历导出到 layout_data_NAME.json 和 layers_NAME/，可重复')
+    parser.add_argument('--disable-stage', action='append', default=[], metavar='STAGE',
+                        help='禁用提取阶段（如 effects、export），可重复')
+    parser.add_argument('--enable-stage', action='append', default=[], metavar='STAGE',
+                        help='启用默认禁用的提取阶段，可重复')
+    parser.add_argument('--plugin', action='append', default=[], metavar='MODULE',
+                        help='导入模块以注册第三方提取阶段，可重复')
+    parser.add_argument('--sample-pixel-colors', action='store_true',
+                        help='从像素图层的合成图中采样主色，输出为 pixel_colors 令牌')
+    parser.add_argument('--no-smartobject-cache', action='store_true',
+                        help='不使用智能对象渲染缓存')
+    parser.add_argument('--render-timeout', type=float, default=RENDER_TIMEOUT, metavar='SECONDS',
+                        help='单个图层的合成时间上限，超时后使用回退渲染')
+    parser.add_argument('--render-memory', type=int, default=RENDER_MEMORY_MB, metavar='MB',
+                        help='单个图层合成的额外内存上限，超限后使用回退渲染')
+    parser.add_argument('--render-fallback', choices=('downscale', 'placeholder'),
+                        default=RENDER_FALLBACK, help='合成超限时的回退方式')
+    parser.add_argument('--list-stages', action='store_true', help='列出所有提取阶段后退出')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    global PSD_FILE, OUTPUT_DIR, ASSETS_DIR, SMARTOBJECT_CACHE
+    global RENDER_TIMEOUT, RENDER_MEMORY_MB, RENDER_FALLBACK, SAMPLE_PIXEL_COLORS
+
+    args = parse_args(argv)
+    for module_name in args.plugin:
+        registered = set(EXTRACTOR_STAGES)
+        importlib.import_module(module_name)
+        added = [name for name in EXTRACTOR_STAGES if name not in registered]
+        if added:
+            logger.info(f"插件 {module_name} 注册了提取阶段: {', '.join(added)}")
+        else:
+            logger.warning(f"插件 {module_name} 没有注册任何提取阶段")
+    try:
+        for name in args.enable_stage:
+            set_stage_enabled(name, True)
+        for name in args.disable_stage:
+            set_stage_enabled(name, False)
+    except ValueError as e:
+        print(f"❌ 错误: {e}")
+        return
+    if args.list_stages:
+        for name, stage in EXTRACTOR_STAGES.items():
+            layer_types = ", ".join(t.__name__ for t in stage["layer_types"] or ()) or "all"
+            state = "enabled" if stage["enabled"] else "disabled"
+            print(f"{name}\t{state}\t{layer_types}")
+        return
+
+    reset_run_state()
+    PSD_FILE = args.psd
+    OUTPUT_DIR = args.output
+    ASSETS_DIR = os.path.join(OUTPUT_DIR, 'assets')
+    os.makedirs(ASSETS_DIR, exist_ok=True)
+    SMARTOBJECT_CACHE = not args.no_smartobject_cache
+    SAMPLE_PIXEL_COLORS = SAMPLE_PIXEL_COLORS or args.sample_pixel_colors
+    RENDER_TIMEOUT = args.render_timeout
+    RENDER_MEMORY_MB = args.render_memory
+    RENDER_FALLBACK = args.render_fallback
+    if RENDER_MEMORY_MB and not memory_limit_supported():
+        logger.warning("当前平台无法限制子进程内存（需要 Linux 的 /proc 和 RLIMIT_AS），--render-memory 不生效")
+        print("⚠️  当前平台无法限制合成内存，--render-memory 不生效（--render-timeout 仍然有效）")
+        RENDER_MEMORY_MB = None
 
-def main():
     if not os.path.exists(PSD_FILE):
         logger.error(f"找不到文件 '{PSD_FILE}'")
         print(f"❌ 错误: 找不到文件 '{PSD_FILE}'")
         return
 
+    # 构建选择集：(文件后缀, 过滤器)。只给出命名选择集时不导出默认选择集
+    common = {
+        "exclude": args.exclude,
+        "component_types": args.component,
+        "content_types": args.content,
+        "include_hidden": args.include_hidden
+    }
+    selections = []
+    if args.include or not args.selection:
+        selections.append(("", make_layer_filter(include=args.include, **common)))
+    for name, patterns in args.selection:
+        selections.append((f"_{safe_filename(name)}", make_layer_filter(include=patterns, **common)))
+    filters = [layer_filter for _, layer_filter in selections]
+    filters_active = bool(args.include or args.exclude or args.component
+                          or args.content or args.selection)
+
     try:
         logger.info(f"正在加载 {PSD_FILE}")
         print(f"🔄 正在加载 {PSD_FILE} ...")
         psd = PSDImage.open(PSD_FILE)
 
-        logger.info("正在生成整体预览图")
-        print("🖼️  正在生成整体预览图...")
-        psd.composite().save(os.path.join(OUTPUT_DIR, 'full_preview.png'))
-
         logger.info("正在解析图层结构并切图")
         print("🔍 正在解析图层结构并切图...")
         structure = []
-        layer_count = len(list(psd))
-        for i, layer in enumerate(psd):
+        top_layers = list(psd)
+        layer_count = len(top_layers)
+        top_paths = sibling_paths([layer.name for layer in top_layers])
+        for i, (layer, path) in enumerate(zip(top_layers, top_paths)):
             try:
-                res = parse_layer(layer, str(i))
+                res = parse_layer(layer, str(i), path=path, selections=filters)
                 if res:
                     # 添加 zIndex 信息（倒序，顶层图层的 zIndex 值更大）
                     res["zIndex"] = layer_count - i
@@ -607,84 +1556,59 @@ def main():
             except Exception as e:
                 logger.error(f"解析图层 '{layer.name}' 时出错: {e}")
 
-        # 生成增强的 layout_data.json
-        json_path = os.path.join(OUTPUT_DIR, 'layout_data.json')
-        output_data = {
-            "metadata": {
-                "design_width": int(psd.width),
-                "design_height": int(psd.height),
-                "generated_at": datetime.now().isoformat(),
-                "psd_file": PSD_FILE,
-                "total_layers": len(structure)
-            },
-            "design_tokens": extract_design_tokens(),
-            "layers": structure
-        }
+        save_smartobject_cache()
 
-        logger.info(f"保存元数据和图层结构到 {json_path}")
-        with open(json_path, 'w', encoding='utf-8') as f:
-            json.dump(output_data, f, indent=2, ensure_ascii=False)
-
-        # 拆分每个图层为独立的 JSON 文件
-        logger.info("正在拆分图层为独立文件...")
-        layers_dir = os.path.join(OUTPUT_DIR, 'layers')
-        os.makedirs(layers_dir, exist_ok=True)
-
-        for i, layer_data in enumerate(structure):
-            layer_name = safe_filename(layer_data.get("name", f"layer_{i}"))
-            layer_file = os.path.join(layers_dir, f"{i}_{layer_name}.json")
-
-            layer_output = {
-                "metadata": {
-                    "design_width": int(psd.width),
-                    "design_height": int(psd.height),
-                    "generated_at": datetime.now().isoformat(),
-                    "psd_file": PSD_FILE,
-                    "layer_index": i,
-                    "layer_name": layer_data.get("name")
-                },
-                "design_tokens": extract_design_tokens(),
-                "layer": layer_data
-            }
+        # 有过滤条件时只合成被选中的子树，避免为跳过的图层付出合成代价
+        logger.info("正在生成整体预览图")
+        print("🖼️  正在生成整体预览图...")
+        preview_filter = None
+        if filters_active:
+            preview_filter = lambda l: id(l) in exported_layer_ids and l.is_visible()
+        render_preview(psd, preview_filter).save(os.path.join(OUTPUT_DIR, 'full_preview.png'))
 
-            with open(layer_file, 'w', encoding='utf-8') as f:
-                json.dump(layer_output, f, indent=2, ensure_ascii=False)
+        # 整理设计令牌（只计算一次，供所有输出文件复用）
+        tokens = extract_design_tokens()
 
-        # 生成图层索引文件
-        index_file = os.path.join(layers_dir, "index.json")
-        layer_index = {
-            "total_layers": len(structure),
-            "layers": [
-                {
-                    "index": i,
-                    "name": layer.get("name"),
-                    "file": f"{i}_{safe_filename(layer.get('name', f'layer_{i}'))}.json"
-                }
-                for i, layer in enumerate(structure)
-            ]
-        }
-        with open(index_file, 'w', encoding='utf-8') as f:
-            json.dump(layer_index, f, indent=2, ensure_ascii=False)
+        outputs = []
+        for n, (suffix, _) in enumerate(selections):
+            selected = select_structure(structure, n)
+            json_path, layers_dir = write_outputs(psd, selected, tokens, suffix)
+            outputs.append((json_path, layers_dir, len(selected)))
 
         # 保存单独的设计令牌文件
         tokens_path = os.path.join(OUTPUT_DIR, 'design_tokens.json')
         logger.info(f"保存设计令牌到 {tokens_path}")
         with open(tokens_path, 'w', encoding='utf-8') as f:
-            json.dump(extract_design_tokens(), f, indent=2, ensure_ascii=False)
+            json.dump(tokens, f, indent=2, ensure_ascii=False)
 
         logger.info("处理完成")
         print(f"✅ 处理完成！")
-        print(f"   - 元数据和图层结构: {json_path}")
-        print(f"   - 单个图层文件: {layers_dir}/ (共 {len(structure)} 个)")
-        print(f"   - 图层索引: {layers_dir}/index.json")
+        for json_path, layers_dir, count in outputs:
+            print(f"   - 元数据和图层结构: {json_path}")
+            print(f"   - 单个图层文件: {layers_dir}/ (共 {count} 个)")
+            print(f"   - 图层索引: {layers_dir}/index.json")
         print(f"   - 设计令牌: {tokens_path}")
         print(f"   - 预览图: {OUTPUT_DIR}/full_preview.png")
         print(f"   - 资源文件: {ASSETS_DIR}/")
         print(f"   - 总图层数: {len(structure)}")
+        if render_issues:
+            print(f"   - ⚠️  合成超限图层: {len(render_issues)} 个")
+            for issue in render_issues:
+                print(f"     · {issue['path']}: {issue['reason']} → {issue['fallback']}")
+        if SMARTOBJECT_CACHE:
+            cache_stats = smartobject_cache["stats"]
+            print(f"   - 智能对象缓存: 命中 {cache_stats['hits']} 次, "
+                  f"未命中 {cache_stats['misses']} 次")
+        print(f"   - 提取阶段统计:")
+        print(format_stage_stats())
+        logger.info("提取阶段统计:\n" + format_stage_stats())
 
     except Exception as e:
         logger.error(f"处理 PSD 文件时出错: {e}", exc_info=True)
         print(f"❌ 错误: {e}")
 
 if __name__ == '__main__':
+    # 作为脚本运行时模块名为 __main__；让插件中的 import psd_to_vibe 拿到同一个模块，
+    # 否则插件会注册到另一份模块副本的 EXTRACTOR_STAGES 中
+    sys.modules.setdefault('psd_to_vibe', sys.modules[__name__])
     main()
\ No newline at end of file
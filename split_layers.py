@@ -7,14 +7,65 @@
 import os
 import json
 import re
+import argparse
 from datetime import datetime
 
 
+SIZE_UNITS = ('tokens', 'bytes')
+COMPACT_SEPARATORS = (',', ':')
+
+
 def safe_filename(name):
     """生成安全的文件名"""
     return re.sub(r'[^\w\-_]', '_', name).strip()
 
 
+def escape_path_segment(name):
+    """转义图层名中的 %、/ 和 #，使其可以无歧义地作为图层路径的一段"""
+    return str(name).replace('%', '%25').replace('/', '%2F').replace('#', '%23')
+
+
+def sibling_paths(names, parent_path=''):
+    """
+    为一组兄弟图层生成唯一的图层路径
+
+    路径由转义后的图层名以 "/" 连接；同名兄弟图层中第 n 个（n >= 2）追加 "#n"，
+    如 "首页/按钮"、"首页/按钮#2"。psd_to_vibe 导出、过滤、指纹和分块都使用这一格式。
+    """
+    seen = {}
+    paths = []
+    for name in names:
+        segment = escape_path_segment(name)
+        seen[segment] = seen.get(segment, 0) + 1
+        if seen[segment] > 1:
+            segment = f'{segment}#{seen[segment]}'
+        paths.append(f'{parent_path}/{segment}' if parent_path else segment)
+    return paths
+
+
+def positive_int(value):
+    """argparse 类型：正整数"""
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"必须是正整数: {value}")
+    return number
+
+
+def save_shared_files(output_dir, metadata, design_tokens):
+    """保存独立的 metadata.json 和 design_tokens.json，返回两个文件路径"""
+    metadata_file = os.path.join(output_dir, 'metadata.json')
+    with open(metadata_file, 'w', encoding='utf-8') as f:
+        json.dump(metadata, f, indent=2, ensure_ascii=False)
+    print(f"  ✅ 元数据: {metadata_file}")
+
+    tokens_file = os.path.join(output_dir, 'design_tokens.json')
+    with open(tokens_file, 'w', encoding='utf-8') as f:
+        json.dump(design_tokens, f, indent=2, ensure_ascii=False)
+    print(f"  ✅ 设计令牌: {tokens_file}")
+
+    return metadata_file, tokens_file
+
+
 def split_layout_data(input_file, output_dir='vibe_context/layers'):
     """
     拆分 layout_data.json 为多个独立的图层文件
@@ -42,15 +93,7 @@ def split_layout_data(input_file, output_dir='vibe_context/layers'):
     os.makedirs(output_dir, exist_ok=True)
 
     # 保存独立的 metadata.json 和 design_tokens.json
-    metadata_file = os.path.join(output_dir, 'metadata.json')
-    with open(metadata_file, 'w', encoding='utf-8') as f:
-        json.dump(metadata, f, indent=2, ensure_ascii=False)
-    print(f"  ✅ 元数据: {metadata_file}")
-
-    tokens_file = os.path.join(output_dir, 'design_tokens.json')
-    with open(tokens_file, 'w', encoding='utf-8') as f:
-        json.dump(design_tokens, f, indent=2, ensure_ascii=False)
-    print(f"  ✅ 设计令牌: {tokens_file}")
+    metadata_file, tokens_file = save_shared_files(output_dir, metadata, design_tokens)
 
     # 为每个图层创建独立的 JSON 文件（精简版，不包含重复的 metadata 和 design_tokens）
     for i, layer in enumerate(layers):
@@ -108,9 +151,184 @@ def split_layout_data(input_file, output_dir='vibe_context/layers'):
     print(f"   - 共 {len(layers)} 个图层文件")
 
 
+def estimate_size(obj, unit='tokens'):
+    """
+    估算对象序列化为紧凑 JSON 后的大小（与分块文件的写入格式一致）
+
+    Args:
+        obj: 可 JSON 序列化的对象
+        unit: 'bytes' 返回 UTF-8 字节数；'tokens' 返回估算的 token 数
+              （ASCII 约 4 字符一个 token，中文等非 ASCII 字符约 1 字符一个 token）
+    """
+    text = json.dumps(obj, ensure_ascii=False, separators=COMPACT_SEPARATORS)
+    if unit == 'bytes':
+        return len(text.encode('utf-8'))
+    ascii_count = len(text.encode('ascii', 'ignore'))
+    return (ascii_count + 3) // 4 + (len(text) - ascii_count)
+
+
+def _flatten_units(layers, budget, unit, parent_path=''):
+    """
+    将图层展开为待打包的单元：未超预算的图层整体作为一个单元，
+    超预算的组沿 children 递归拆分（组本身保留为不含 children 的外壳）
+    """
+    units = []
+    names = [layer.get('name', f'layer_{i}') for i, layer in enumerate(layers)]
+    for layer, path in zip(layers, sibling_paths(names, parent_path)):
+        # psd_to_vibe 导出的图层自带路径（与过滤、指纹使用的路径一致）
+        path = layer.get('path', path)
+        size = estimate_size({'path': path, 'layer': layer}, unit) + 1
+        children = layer.get('children')
+
+        if size <= budget or not children:
+            units.append({
+                'path': path,
+                'layer': layer,
+                'size': size,
+                'oversized': size > budget
+            })
+            continue
+
+        # 组过大：外壳单独成单元，子图层继续递归
+        shell = {k: v for k, v in layer.items() if k != 'children'}
+        shell['children_split'] = len(children)
+        units.append({
+            'path': path,
+            'layer': shell,
+            'size': estimate_size({'path': path, 'layer': shell}, unit) + 1,
+            'oversized': False
+        })
+        units.extend(_flatten_units(children, budget, unit, path))
+
+    return units
+
+
+def plan_chunks(layers, budget, unit='tokens'):
+    """
+    按预算规划分块：按文档顺序把相邻的小图层打包在一起，过大的组递归拆分
+
+    Returns:
+        分块列表，每个分块为单元列表（单元包含 path、layer、size、oversized）
+    """
+    # 预留分块文件外层结构的开销
+    envelope = estimate_size({'chunk_index': 0, 'unit': unit, 'layers': [], 'estimated_size': budget}, unit)
+    budget = max(budget - envelope, 1)
+
+    chunks = []
+    current = []
+    current_size = 0
+    for u in _flatten_units(layers, budget, unit):
+        if current and current_size + u['size'] > budget:
+            chunks.append(current)
+            current, current_size = [], 0
+        current.append(u)
+        current_size += u['size']
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def split_layout_chunks(input_file, output_dir='vibe_context/layers', budget=8000, unit='tokens'):
+    """
+    按 token / 字节预算将 layout_data.json 拆分为多个分块文件
+
+    Args:
+        input_file: layout_data.json 文件路径
+        output_dir: 输出目录
+        budget: 每个分块的目标大小
+        unit: 预算单位，'tokens' 或 'bytes'
+    """
+    if not os.path.exists(input_file):
+        print(f"❌ 错误: 找不到文件 '{input_file}'")
+        return
+
+    print(f"📖 正在读取 {input_file}...")
+    with open(input_file, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+
+    metadata = data.get('metadata', {})
+    design_tokens = data.get('design_tokens', {})
+    layers = data.get('layers', [])
+
+    print(f"📦 找到 {len(layers)} 个顶层图层，按 {budget} {unit} 预算分块...")
+
+    os.makedirs(output_dir, exist_ok=True)
+    metadata_file, tokens_file = save_shared_files(output_dir, metadata, design_tokens)
+
+    chunk_entries = []
+    for n, units in enumerate(plan_chunks(layers, budget, unit)):
+        chunk_file = f'chunk_{n:03d}.json'
+        layer_paths = [u['path'] for u in units]
+        chunk_data = {
+            'chunk_index': n,
+            'unit': unit,
+            'layers': [{'path': u['path'], 'layer': u['layer']} for u in units]
+        }
+        # 大小字段本身也计入文件，迭代到数值不再变化（位数变化最多几轮）
+        estimated_size = 0
+        while True:
+            chunk_data['estimated_size'] = estimated_size
+            size = estimate_size(chunk_data, unit)
+            if size == estimated_size:
+                break
+            estimated_size = size
+
+        # 分块文件使用紧凑格式，节省上下文窗口
+        with open(os.path.join(output_dir, chunk_file), 'w', encoding='utf-8') as f:
+            json.dump(chunk_data, f, ensure_ascii=False, separators=COMPACT_SEPARATORS)
+
+        oversized = estimated_size > budget
+        chunk_entries.append({
+            'index': n,
+            'file': chunk_file,
+            'estimated_size': estimated_size,
+            'oversized': oversized,
+            'layer_paths': layer_paths
+        })
+        flag = ' ⚠️ 超出预算' if oversized else ''
+        print(f"  ✅ {chunk_file}: {len(units)} 个图层, ~{estimated_size} {unit}{flag}")
+
+    index_file = os.path.join(output_dir, 'index.json')
+    index_data = {
+        'summary': {
+            'total_layers': len(layers),
+            'total_chunks': len(chunk_entries),
+            'budget': budget,
+            'unit': unit,
+            'design_width': metadata.get('design_width'),
+            'design_height': metadata.get('design_height'),
+            'generated_at': datetime.now().isoformat()
+        },
+        'files': {
+            'metadata': 'metadata.json',
+            'design_tokens': 'design_tokens.json'
+        },
+        'chunks': chunk_entries
+    }
+
+    with open(index_file, 'w', encoding='utf-8') as f:
+        json.dump(index_data, f, indent=2, ensure_ascii=False)
+
+    print(f"\n✅ 分块完成！")
+    print(f"   - 索引文件: {index_file}")
+    print(f"   - 元数据: {metadata_file}")
+    print(f"   - 设计令牌: {tokens_file}")
+    print(f"   - 共 {len(chunk_entries)} 个分块文件")
+
+
 if __name__ == '__main__':
-    # 使用默认路径
-    input_file = 'vibe_context/layout_data.json'
-    output_dir = 'vibe_context/layers'
+    parser = argparse.ArgumentParser(description='拆分 layout_data.json 为图层文件')
+    parser.add_argument('input_file', nargs='?', default='vibe_context/layout_data.json',
+                        help='layout_data.json 文件路径')
+    parser.add_argument('output_dir', nargs='?', default='vibe_context/layers',
+                        help='输出目录')
+    parser.add_argument('--budget', type=positive_int, default=None,
+                        help='按预算分块：每个分块的目标大小（不指定则每个顶层图层一个文件）')
+    parser.add_argument('--unit', choices=SIZE_UNITS, default='tokens',
+                        help='预算单位：tokens（估算）或 bytes')
+    args = parser.parse_args()
 
-    split_layout_data(input_file, output_dir)
+    if args.budget is not None:
+        split_layout_chunks(args.input_file, args.output_dir, args.budget, args.unit)
+    else:
+        split_layout_data(args.input_file, args.output_dir)